@@ -1,7 +1,6 @@
 import numpy as np
 import torch
 from collections import deque, namedtuple
-import random
 import math
 from itertools import count
 import matplotlib.pyplot as plt
@@ -12,25 +11,114 @@ import os
 
 # From https://github.com/pytorch/tutorials/blob/main/intermediate_source/reinforcement_q_learning.py
 
+# Batch of sampled transitions. done marks transitions that ended an episode,
+# so the non-final mask is a slice of stored flags rather than a Python scan.
+Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward', 'done'))
+
 class ReplayMemory:
-    def __init__(self, capacity):
-        self.memory = deque([], maxlen=capacity)
+    def __init__(self, 
+                 capacity, # maximum number of transitions
+                 n_observations # state dimensions
+                 ):
+        # Transitions are stored as preallocated ring buffers (one tensor per field)
+        # so that sampling is a single indexing op instead of a Python loop
+        pin_memory = torch.cuda.is_available()
+
+        self.capacity = capacity
+        self.states = torch.empty((capacity, n_observations), dtype=torch.float32, pin_memory=pin_memory)
+        self.actions = torch.empty((capacity, 1), dtype=torch.long, pin_memory=pin_memory)
+        self.next_states = torch.empty((capacity, n_observations), dtype=torch.float32, pin_memory=pin_memory)
+        self.rewards = torch.empty(capacity, dtype=torch.float32, pin_memory=pin_memory)
+        self.dones = torch.empty(capacity, dtype=torch.bool, pin_memory=pin_memory)
+
+        self.pos = 0 # next slot to write
+        self.size = 0 # number of stored transitions
+
+        # Pinned staging buffers for sampled minibatches and a dedicated stream for
+        # their host-to-device copies (CUDA only)
+        self._staging = None
+        self._copy_stream = torch.cuda.Stream() if pin_memory else None
+        self._copy_done = torch.cuda.Event() if pin_memory else None
+
+    def push(self, state, action, next_state, reward, done):
+        """Save a batch of transitions, one row per environment (copied into CPU
+        storage, detached from any graph)"""
+        n = state.shape[0]
+        first = min(n, self.capacity - self.pos) # rows that fit before wrapping around
+
+        for buffer, value in ((self.states, state), (self.actions, action), (self.next_states, next_state),
+                              (self.rewards, reward), (self.dones, done)):
+            if n == 1 and not torch.is_tensor(value) and np.ndim(value) == 0:
+                # Scalar reward/done from a single environment
+                buffer[self.pos] = value.item() if isinstance(value, np.generic) else value
+                continue
+
+            value = torch.as_tensor(value).detach().reshape(n, *buffer.shape[1:])
+            buffer[self.pos:self.pos + first].copy_(value[:first])
+            if n > first:
+                buffer[:n - first].copy_(value[first:])
+
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size, device, replacement=True, out=None):
+        # out: optional Transition of device tensors to copy the minibatch into
+        # (e.g. the static inputs of a captured CUDA graph) instead of allocating
+        # Sampling with replacement (as is standard for DQN) is a single randint;
+        # without replacement, take the head of a random permutation
+        if replacement:
+            idx = torch.randint(0, self.size, (batch_size,))
+        else:
+            idx = torch.randperm(self.size)[:batch_size]
+        buffers = Transition(self.states, self.actions, self.next_states, self.rewards, self.dones)
+
+        if self._copy_stream is None or torch.device(device).type != "cuda":
+            batch = Transition(*(buffer[idx].to(device) for buffer in buffers))
+            if out is None:
+                return batch
+            for dst, sampled in zip(out, batch):
+                dst.copy_(sampled)
+            return out
+
+        if self._staging is None or self._staging.state.shape[0] != batch_size:
+            self._staging = Transition(*(torch.empty((batch_size, *buffer.shape[1:]), dtype=buffer.dtype, pin_memory=True)
+                                         for buffer in buffers))
+
+        # Gather into the staging buffers once the previous copy out of them is done,
+        # then copy to the device asynchronously on the copy stream
+        self._copy_done.synchronize()
+        for buffer, staging in zip(buffers, self._staging):
+            torch.index_select(buffer, 0, idx, out=staging)
+
+        compute_stream = torch.cuda.current_stream()
+        with torch.cuda.stream(self._copy_stream):
+            if out is None:
+                batch = Transition(*(staging.to(device, non_blocking=True) for staging in self._staging))
+            else:
+                # The destinations may still be read by work queued on the compute stream
+                self._copy_stream.wait_stream(compute_stream)
+                for dst, staging in zip(out, self._staging):
+                    dst.copy_(staging, non_blocking=True)
+                batch = out
+            self._copy_done.record()
 
-    def push(self, Transition, *args):
-        """Save a transition"""
-        self.memory.append(Transition(*args))
+        # The compute stream waits for the copies before using the minibatch
+        compute_stream.wait_stream(self._copy_stream)
+        if out is None:
+            for t in batch:
+                t.record_stream(compute_stream)
 
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        return batch
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
     
 class DQN(torch.nn.Module):
     def __init__(self, 
                  n_observations, # state dimensions
                  n_actions, # number of actions
-                 lr=1e-4 # learning rate
+                 lr=1e-4, # learning rate
+                 capturable=False # allow the optimizer step to be captured in a CUDA graph
                  ):
         super(DQN, self).__init__()
         self.layer1 = torch.nn.Linear(n_observations, 256)
@@ -39,16 +127,28 @@ class DQN(torch.nn.Module):
         self.layer4 = torch.nn.Linear(256, 256)
         self.layer5 = torch.nn.Linear(256, n_actions)
 
-        self.optimizer = torch.optim.AdamW(self.parameters(), lr=lr, amsgrad=True)
+        # Flat parameter list, so the training step doesn't walk the module tree
+        self._param_list = list(self.parameters())
+
+        self.optimizer = torch.optim.AdamW(self._param_list, lr=lr, amsgrad=True, capturable=capturable)
+
+        # CUDA graph of the optimization step, captured on first use
+        self._graph = None
+        self._static_batch = None
 
     # Called with either one element to determine next action, or a batch
     # during optimization. Returns tensor([[left0exp,right0exp]...]).
-    def forward(self, x):
-        x = torch.nn.functional.relu(self.layer1(x))
-        x = torch.nn.functional.relu(self.layer2(x))
-        x = torch.nn.functional.relu(self.layer3(x))
-        x = torch.nn.functional.relu(self.layer4(x))
-        return self.layer5(x)
+    # With amp=True the hidden layers run in bfloat16 on CUDA; the output layer
+    # always runs in float32 so Q-values are not rounded (the autocast weight
+    # cache is disabled so this can be captured in a CUDA graph).
+    def forward(self, x, amp=False):
+        with torch.autocast(x.device.type, dtype=torch.bfloat16,
+                            enabled=amp and x.device.type == "cuda", cache_enabled=False):
+            x = torch.nn.functional.relu(self.layer1(x))
+            x = torch.nn.functional.relu(self.layer2(x))
+            x = torch.nn.functional.relu(self.layer3(x))
+            x = torch.nn.functional.relu(self.layer4(x))
+        return self.layer5(x.float())
     
     def optimize_model(self, 
                        memory,  # Replay memory 
@@ -56,60 +156,91 @@ class DQN(torch.nn.Module):
                        device, # device to use
                        gamma, # discount factor
                        target_net, # target network
-                       Transition # named tuple for storing transitions
+                       cuda_graph=False, # capture the optimization step as a CUDA graph
+                       replacement=True # sample the minibatch with replacement
                        ):
         if len(memory) < batch_size:
             return
         
-        transitions = memory.sample(batch_size)
-        
-        # Transpose the batch (see https://stackoverflow.com/a/19343/3343043 for
-        # detailed explanation). This converts batch-array of Transitions
-        # to Transition of batch-arrays.
-        batch = Transition(*zip(*transitions))
-
-        # Compute a mask of non-final states and concatenate the batch elements
-        # (a final state would've been the one after which simulation ended)
-        non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                            batch.next_state)), device=device, dtype=torch.bool)
-        
-        non_final_next_states = torch.cat([s for s in batch.next_state
-                                                    if s is not None])
-        
-        state_batch = torch.cat(batch.state)
-        action_batch = torch.cat(batch.action)
-        reward_batch = torch.cat(batch.reward)
+        if cuda_graph and self._graph is not None:
+            # Copy the minibatch straight into the captured input tensors and replay the step
+            memory.sample(batch_size, device, replacement, out=self._static_batch)
+            self._graph.replay()
+            return
+
+        batch = memory.sample(batch_size, device, replacement)
+
+        if not cuda_graph:
+            self._optimize_step(*batch, gamma, target_net)
+        else:
+            self._capture_optimize_step(batch, gamma, target_net)
 
+    def _optimize_step(self, state_batch, action_batch, next_state_batch, reward_batch, done_batch, gamma, target_net):
         # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
         # columns of actions taken. These are the actions which would've been taken
         # for each batch state according to policy_net
-        state_action_values = self(state_batch).gather(1, action_batch)
+        state_action_values = self(state_batch, amp=True).gather(1, action_batch)
 
         # Compute V(s_{t+1}) for all next states.
-        # Expected values of actions for non_final_next_states are computed based
+        # Expected values of actions for next states are computed based
         # on the "older" target_net; selecting their best reward with max(1).values
-        # This is merged based on the mask, such that we'll have either the expected
-        # state value or 0 in case the state was final.
-        next_state_values = torch.zeros(batch_size, device=device)
-
         with torch.no_grad():
-            next_state_values[non_final_mask] = target_net(non_final_next_states).max(1).values
+            next_state_values = target_net(next_state_batch, amp=True).max(1).values
 
-        # Compute the expected Q values
-        expected_state_action_values = (next_state_values * gamma) + reward_batch
+        # Compute the expected Q values. The value of a final state (one after
+        # which the simulation ended) is zeroed by the done mask, so shapes never
+        # depend on the data (required for CUDA graph capture).
+        expected_state_action_values = reward_batch + gamma * next_state_values * (1. - done_batch.float())
 
         # Compute Huber loss
-        criterion = torch.nn.SmoothL1Loss()
-        loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+        loss = torch.nn.functional.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
 
         # Optimize the model
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         loss.backward()
 
         # In-place gradient clipping
-        torch.nn.utils.clip_grad_value_(self.parameters(), 100)
+        torch.nn.utils.clip_grad_value_(self._param_list, 100, foreach=True)
         self.optimizer.step()
 
+    def _capture_optimize_step(self, batch, gamma, target_net):
+        # Static input tensors; later minibatches are copied into these before replay
+        self._static_batch = Transition(*(t.clone() for t in batch))
+
+        # Warm-up steps update the parameters and optimizer state, so snapshot them
+        # and restore afterwards to keep the training schedule unchanged
+        saved_params = [p.detach().clone() for p in self._param_list]
+        saved_state = {p: {key: value.clone() for key, value in self.optimizer.state[p].items()}
+                       for p in self._param_list if p in self.optimizer.state}
+
+        # Warm up on a side stream before capturing (see torch.cuda.graphs docs)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._optimize_step(*self._static_batch, gamma, target_net)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Restore in place (the captured graph must see the same tensors). Adam state
+        # that didn't exist before warm-up starts from zeros, including the step count.
+        with torch.no_grad():
+            for p, saved in zip(self._param_list, saved_params):
+                p.copy_(saved)
+                for key, value in self.optimizer.state[p].items():
+                    if p in saved_state:
+                        value.copy_(saved_state[p][key])
+                    else:
+                        value.zero_()
+
+        # Gradients are allocated from the graph's private memory pool during capture
+        self.optimizer.zero_grad(set_to_none=True)
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._optimize_step(*self._static_batch, gamma, target_net)
+
+        # Capturing doesn't run the step, so replay it once for this minibatch
+        self._graph.replay()
+
 class EpsilonGreedyPolicy:
     def __init__(self,
                  eps_end,
@@ -124,22 +255,58 @@ class EpsilonGreedyPolicy:
         self.n_actions = n_actions
         self.device = device
 
-    # Epsilon greedy selection
+        # eps_end + (eps_start - eps_end) * exp(-steps_done / eps_decay), kept
+        # incrementally: each step scales the distance to eps_end by exp(-1 / eps_decay)
+        self._eps = eps_start
+        self._decay_mul = math.exp(-1. / eps_decay)
+
+        # Random exploration draws come from a dedicated generator into a reused
+        # buffer. Both live on the CPU, where the environment consumes actions.
+        # The generator is seeded from the global RNG so torch.manual_seed still
+        # makes exploration reproducible.
+        self._gen = torch.Generator()
+        self._gen.manual_seed(int(torch.randint(2**62, ())))
+        self._action_buf = torch.empty((1, 1), dtype=torch.long)
+
+        # Device-side copy of the state for greedy selection, reused between calls
+        self._state_buf = None
+
+    # Epsilon greedy selection for a batch of states, one row per environment.
+    # Returns a (n_envs, 1) tensor of actions on the CPU, where the environment
+    # consumes them, so reading an action back never waits on the device.
+    # The returned tensor may be reused by the next call. state may live in pinned
+    # memory and be overwritten as soon as this returns.
     def select_action(self, state, policy_net):
-        sample = random.random()
-        eps_threshold = self.eps_end + (self.eps_start - self.eps_end) * \
-            math.exp(-1. * self.steps_done / self.eps_decay)
+        n_envs = state.shape[0]
+        eps_threshold = self._eps
         
-        self.steps_done += 1
-
-        if sample > eps_threshold:
-            with torch.no_grad():
-                # t.max(1) will return the largest column value of each row.
-                # second column on max result is index of where max element was
-                # found, so we pick action with the larger expected reward.
-                return policy_net(state).max(1).indices.view(1, 1)
-        else:
-            return torch.tensor([[random.randint(0, self.n_actions - 1)]], device=self.device, dtype=torch.long)
+        self.steps_done += n_envs
+        self._eps = self.eps_end + (self._eps - self.eps_end) * self._decay_mul ** n_envs
+
+        if self._action_buf.shape[0] != n_envs:
+            self._action_buf = torch.empty((n_envs, 1), dtype=torch.long)
+
+        explore = torch.rand(n_envs, generator=self._gen) <= eps_threshold
+        random_actions = torch.randint(0, self.n_actions, (n_envs, 1), generator=self._gen, out=self._action_buf)
+
+        if explore.all():
+            return random_actions
+
+        # Kept in float32: rounding the Q-values to bfloat16 would create ties that
+        # argmax breaks toward the lowest action index
+        with torch.no_grad():
+            # t.max(1) will return the largest column value of each row.
+            # second column on max result is index of where max element was
+            # found, so we pick action with the larger expected reward.
+            if self._state_buf is None or self._state_buf.shape != state.shape:
+                self._state_buf = torch.empty(state.shape, dtype=torch.float32, device=self.device)
+            self._state_buf.copy_(state, non_blocking=True)
+
+            # Reading the actions back synchronizes, so the copy above has finished
+            # before the caller can reuse state
+            greedy_actions = policy_net(self._state_buf).max(1).indices.view(n_envs, 1).cpu()
+
+        return torch.where(explore.view(n_envs, 1), random_actions, greedy_actions)
 
 def dqn(env, 
         eps_start=0.9,  # start value for epsilon
@@ -149,9 +316,15 @@ def dqn(env,
         gamma=0.99, # discount factor
         N=10000,   # Replay memory max size,
         tau=0.005, # Update rate for target network
+        update_target_every=1, # Number of env steps between target network updates
+        train_every=1, # Number of env steps between optimization phases
+        grad_steps=1, # Number of optimization steps per optimization phase
         batch_size=128, # minibatch size 
         lr=1e-4, # learning rate
-        input_model=None # Input model if applicable
+        input_model=None, # Input model if applicable
+        compile_model=True, # Compile the networks with torch.compile (CUDA only)
+        cuda_graph=True, # Capture the optimization step as a CUDA graph (CUDA only)
+        replacement=True # Sample replay minibatches with replacement
         ):
     
     if not os.path.isdir('./figures'):
@@ -167,25 +340,53 @@ def dqn(env,
     # if GPU is to be used
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+    # Allow TF32 tensor cores for any matmuls left in float32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # Get number of actions from gym action space
     n_actions = env.action_dims
     n_observations = env.state_dims
 
-    policy_net = DQN(n_observations, n_actions).to(device)
+    cuda_graph = cuda_graph and device.type == "cuda"
+
+    policy_net = DQN(n_observations, n_actions, capturable=cuda_graph).to(device)
 
     if input_model is not None:
         checkpoint = torch.load(input_model)
         policy_net.load_state_dict(checkpoint['state_dict'])
+
+        # load_state_dict keeps the saved hyperparameters, so override capturable to
+        # match this run (this also places the step counters on the right device)
+        for group in checkpoint['optimizer']['param_groups']:
+            group['capturable'] = cuda_graph
         policy_net.optimizer.load_state_dict(checkpoint['optimizer'])
 
     target_net = DQN(n_observations, n_actions).to(device)
     target_net.load_state_dict(policy_net.state_dict())
 
+    if compile_model and device.type == "cuda":
+        # Fuse the small MLP into a few kernels and replay them as CUDA graphs.
+        # Compiling in place keeps the state_dict keys unchanged for checkpoints.
+        # Action selection (batch of 1) and optimization (full batch) each get
+        # their own static-shape graph. When the whole optimization step is
+        # captured manually, only fuse (CUDA graphs cannot be nested).
+        mode = "default" if cuda_graph else "reduce-overhead"
+        policy_net.compile(mode=mode, fullgraph=True, dynamic=False)
+        target_net.compile(mode=mode, fullgraph=True, dynamic=False)
+
+    # Parameter lists for the in-place soft update of the target network
+    policy_params = list(policy_net.parameters())
+    target_params = list(target_net.parameters())
+
+    # Rescale tau so that one update every K steps decays the old target weights
+    # as much as K per-step updates would
+    target_tau = 1 - (1 - tau) ** update_target_every
+
     policy = EpsilonGreedyPolicy(eps_end, eps_start, eps_decay, n_actions, device)
 
     # Initialize replay memory with size 10000
-    Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
-    memory = ReplayMemory(N)
+    memory = ReplayMemory(N, n_observations)
 
     rewards = deque() # Save accumulated rewards
     avg_rewards = deque() #Save average reward
@@ -195,6 +396,11 @@ def dqn(env,
     chase_rate = deque()
     win_rate = deque()
 
+    # Reusable CPU staging tensor observations are written into (pinned so the copy
+    # to the device for action selection is asynchronous). States are kept on the
+    # CPU; only sampled minibatches are moved to the device.
+    obs_cpu = torch.empty((1, n_observations), dtype=torch.float32, pin_memory=device.type == "cuda")
+
     for i_episode in range(episodes):
         print(f"Running episode {i_episode}")
         # Initialize the environment and get its state
@@ -204,7 +410,7 @@ def dqn(env,
 
         state = env.normalize(state)
 
-        state = torch.tensor(state, dtype=torch.float32, device=device).unsqueeze(0)
+        obs_cpu.copy_(torch.from_numpy(state))
         ep_reward = 0
 
         if i_episode % (episodes // 200) == 0 or i_episode == episodes - 1:
@@ -216,15 +422,13 @@ def dqn(env,
             if i_episode % (episodes // 200) == 0 or i_episode == episodes - 1:
                 video.update(pygame.surfarray.pixels3d(env.window_surface).swapaxes(0, 1), inverted=False) # THIS LINE
 
-            action = policy.select_action(state, policy_net)
+            action = policy.select_action(obs_cpu, policy_net)
             observation, reward, done, info = env.step(action.item())
             ep_state.append(np.array([observation[0], observation[1], observation[4], observation[5]]))
             ep_reward += (gamma ** t) * reward
 
             observation = env.normalize(observation)
 
-            reward = torch.tensor([reward], device=device)
-
             if done:
                 if info == "evader cornered":
                     chase_count += 1
@@ -235,28 +439,26 @@ def dqn(env,
                 capture_rate.append(capture_count / (i_episode + 1))
                 win_rate.append((capture_count + chase_count) / (i_episode + 1))
 
-                next_state = None
-            else:
-                next_state = torch.tensor(observation, dtype=torch.float32, device=device).unsqueeze(0)
+            next_state = torch.from_numpy(observation)
 
-            # Store the transition in memory
-            memory.push(Transition, state, action, next_state, reward)
+            # Store the transition in memory (the reward is written straight into its buffer)
+            memory.push(obs_cpu, action, next_state, reward, done)
 
             # Move to the next state
-            state = next_state
+            obs_cpu.copy_(next_state)
 
-            # Perform one step of the optimization (on the policy network)
-            policy_net.optimize_model(memory, batch_size, device, gamma, target_net, Transition)
+            # Perform grad_steps steps of the optimization (on the policy network)
+            # every train_every env steps, back to back
+            if policy.steps_done % train_every == 0:
+                for _ in range(grad_steps):
+                    policy_net.optimize_model(memory, batch_size, device, gamma, target_net, cuda_graph, replacement)
 
             # Soft update of the target network's weights
             # θ′ ← τ θ + (1 − τ) θ′
-            target_net_state_dict = target_net.state_dict()
-            policy_net_state_dict = policy_net.state_dict()
-
-            for key in policy_net_state_dict:
-                target_net_state_dict[key] = policy_net_state_dict[key] * tau + target_net_state_dict[key] * (1 - tau)
-
-            target_net.load_state_dict(target_net_state_dict)
+            if policy.steps_done % update_target_every == 0:
+                with torch.no_grad():
+                    torch._foreach_mul_(target_params, 1 - target_tau)
+                    torch._foreach_add_(target_params, policy_params, alpha=target_tau)
 
             if done:
                 break
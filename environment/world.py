@@ -1,12 +1,36 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from environment.agent import Pursuer, Evader
+from environment.agent import Pursuer, Evader, njit
 from environment.player import Player
 import os
 import pygame
 import time
 import random
 
+# Episode outcomes returned by _evaluate_state as codes, indexed into info strings
+_OUTCOMES = (None, "evader succeeds", "pursuer succeeds", "evader cornered")
+
+@njit(cache=True)
+def _evaluate_state(p_state, e_state, obs, area_x, area_y, area_r, d, x_l, x_u, y_l, y_u, k1, k2, dtm1, htm1):
+    # Distances between both agents and between evader and target area
+    distance_pe = np.sqrt((p_state[0] - e_state[0]) ** 2 + (p_state[1] - e_state[1]) ** 2)
+    distance_et = np.sqrt((e_state[0] - area_x) ** 2 + (e_state[1] - area_y) ** 2)
+
+    # Feature vector [p_x, p_y, p_v, p_theta, e_x, e_y, e_vx, e_vy, evader_distance_to_target_area]
+    obs[0:4] = p_state
+    obs[4:8] = e_state
+    obs[8] = distance_et
+
+    # Reward and termination (same precedence as get_reward)
+    if distance_et <= area_r:
+        return distance_pe, distance_et, -10., 1
+    elif distance_pe <= d:
+        return distance_pe, distance_et, 10., 2
+    elif e_state[0] >= x_u or e_state[0] <= x_l or e_state[1] >= y_u or e_state[1] <= y_l:
+        return distance_pe, distance_et, 0., 3
+
+    return distance_pe, distance_et, k1 * (dtm1 - distance_pe) + k2 / (distance_pe + 1e-3) - 0.8 * (distance_et - htm1), 0
+
 class World(object):
     def __init__(self,
                  vp_min=0, vp_max=1.2, u1_max=0.3, u2_max=0.8, 
@@ -67,6 +91,16 @@ class World(object):
         # Use continous action or discrete action
         self.continuous_action = continous_action
 
+        # Preallocated observation buffer filled by step() and reset()
+        self._obs = np.zeros(self.state_dims)
+        self._distance_pe = 0.
+        self._distance_et = 0.
+
+        # Normalization bounds for the feature vector
+        self._obs_min = np.array([self.x_l, self.y_l, self.vp_min, -np.pi/2, self.x_l, self.y_l, self.ve_min, self.ve_min, 0])
+        obs_max = np.array([self.x_u, self.y_u, self.vp_max, np.pi/2, self.x_u, self.y_u, self.ve_max, self.ve_max, max(self.x_u - self.x_l, self.y_u - self.y_l)])
+        self._obs_range = obs_max - self._obs_min
+
     # Distance between pursuer and evader
     @property
     def distance_pe(self):
@@ -133,8 +167,17 @@ class World(object):
         #return self.k1 * (dtm1 - self.distance_pe), None
 
     
+    # Distances, observation, reward and termination for the current agent states,
+    # computed in one pass. Fills self._obs and caches both distances.
+    def _evaluate(self, dtm1, htm1):
+        self._distance_pe, self._distance_et, reward, outcome = _evaluate_state(
+            self.pursuer.state, self.evader.state, self._obs, self.area_x, self.area_y, self.area_r, self.d,
+            self.x_l, self.x_u, self.y_l, self.y_u, self.k1, self.k2, dtm1, htm1)
+        return reward, outcome
+
     # Take a step according to some action
     # Return new_state, reward, done, info (None)
+    # new_state is a buffer that is overwritten by the next step()/reset()
     def step(self, action):
         if not self.initialized:
             raise ValueError("Environment not initialized. Call reset() before calling step().")
@@ -144,17 +187,17 @@ class World(object):
         else:
             action_val = self.action_space[action]
                              
-        dtm1 = self.distance_pe
-        htm1 = self.distance_et
+        dtm1 = self._distance_pe
+        htm1 = self._distance_et
         self.pursuer.update_state(action_val)
         self.evader.update_state(np.array([self.pursuer.position[0], self.pursuer.position[1]]))  
 
         self.pursuer_sprite.update([self.pursuer.position[0], self.pursuer.position[1]], self.pursuer.angle)
         self.evader_sprite.update([self.evader.position[0], self.evader.position[1]], self.evader.angle(self.evader.state))
 
-        reward, info = self.get_reward(dtm1, htm1)
+        reward, outcome = self._evaluate(dtm1, htm1)
 
-        return self.state, reward, self.is_terminal, info
+        return self._obs, reward, outcome != 0, _OUTCOMES[outcome]
     
     # Initialize everything
     def reset(self):
@@ -195,7 +238,9 @@ class World(object):
         self.all_sprites = pygame.sprite.Group()
         self.all_sprites.add(self.pursuer_sprite, self.evader_sprite)
 
-        return self.state
+        self._evaluate(0., 0.)
+
+        return self._obs
 
     # Render 
     def render(self):
@@ -211,7 +256,4 @@ class World(object):
 
     # Normalizing function 
     def normalize(self, state):
-        min_val = np.array([self.x_l, self.y_l, self.vp_min, -np.pi/2, self.x_l, self.y_l, self.ve_min, self.ve_min, 0])
-        max_val = np.array([self.x_u, self.y_u, self.vp_max, np.pi/2, self.x_u, self.y_u, self.ve_max, self.ve_max, max(self.x_u - self.x_l, self.y_u - self.y_l)])
-
-        return (state - min_val) / (max_val - min_val)
+        return (state - self._obs_min) / self._obs_range